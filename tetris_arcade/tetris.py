@@ -6,8 +6,12 @@ distribution.
 
 '''
 
+import os
 import pathlib
 import random
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import arcade
@@ -35,19 +39,28 @@ PLAYER_1_KEYMAP = dict(
     UP=arcade.key.W,
     DOWN=arcade.key.S,
     LEFT=arcade.key.A,
-    RIGHT=arcade.key.D
+    RIGHT=arcade.key.D,
+    HARD_DROP=arcade.key.SPACE
 )
 
 PLAYER_2_KEYMAP = dict(
     UP=arcade.key.UP,
     DOWN=arcade.key.DOWN,
     LEFT=arcade.key.LEFT,
-    RIGHT=arcade.key.RIGHT
+    RIGHT=arcade.key.RIGHT,
+    HARD_DROP=arcade.key.ENTER
 )
 
+# Seconds between updates, and between redraws on screens where nothing moves
+UPDATE_RATE = 1 / 60
+IDLE_UPDATE_RATE = 1 / 2
+
 # Seconds before moving on key hold
 KEY_REPEAT_SPEED = 0.45
 
+# Opacity of the ghost piece showing where the current stone will land
+GHOST_ALPHA = 60
+
 colored_brick_files = [
     'transparent.png',
     'red.png',
@@ -61,6 +74,20 @@ colored_brick_files = [
     'explosion.png'
 ]
 
+# Saved games are kept in the users home directory
+SAVE_DIR = pathlib.Path.home() / '.tetris-arcade'
+AUTOSAVE_SLOT = 'autosave'
+SNAPSHOT_MAGIC = b'TTRS'
+SNAPSHOT_VERSION = 1
+
+# Keys for the quick save slots, saving or loading with shift held
+QUICKSAVE_KEYS = {
+    arcade.key.F1: 'quicksave-1',
+    arcade.key.F2: 'quicksave-2',
+    arcade.key.F3: 'quicksave-3',
+    arcade.key.F4: 'quicksave-4'
+}
+
 # Define the shapes of the single parts
 tetris_shapes = [
     [[1, 1, 1],
@@ -126,6 +153,110 @@ def setup_sprites(grid, left, height, bottom):
     return sprite_list
 
 
+def write_file(path, data):
+    ''' Replace the contents of path without leaving it half written on errors '''
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        # Make the rename itself survive a power cut, not possible on Windows
+        if hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(path.parent, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+    except OSError as e:
+        print(f'Unable to write {path}: {e}')
+
+
+def read_file(path):
+    try:
+        return path.read_bytes()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        print(f'Unable to read {path}: {e}')
+        return None
+
+
+def remove_file(path):
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f'Unable to remove {path}: {e}')
+
+
+# Snapshots are written in the background, but always in order
+snapshot_writer = ThreadPoolExecutor(max_workers=1)
+
+
+class Snapshot():
+    ''' Compact, versioned binary encoding of a game in progress '''
+    def __init__(self, data=b''):
+        self.data = bytearray(data)
+        self.offset = 0
+
+    @classmethod
+    def decode(cls, data):
+        if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError('not a saved game')
+        version = data[len(SNAPSHOT_MAGIC)]
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f'unsupported version {version}')
+        return cls(zlib.decompress(data[len(SNAPSHOT_MAGIC) + 1:]))
+
+    def encode(self):
+        return SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) + zlib.compress(self.data)
+
+    def write(self, fmt, *values):
+        self.data += struct.pack('<' + fmt, *values)
+
+    def read(self, fmt):
+        values = struct.unpack_from('<' + fmt, self.data, self.offset)
+        self.offset += struct.calcsize('<' + fmt)
+        return values[0] if len(values) == 1 else values
+
+    def write_bytes(self, values):
+        self.write('H', len(values))
+        self.data += bytes(values)
+
+    def read_bytes(self):
+        length = self.read('H')
+        values = list(self.data[self.offset:self.offset + length])
+        if len(values) != length:
+            raise ValueError('truncated saved game')
+        self.offset += length
+        return values
+
+    def write_grid(self, grid):
+        self.write('B', len(grid[0]))
+        self.write_bytes([cell for row in grid for cell in row])
+
+    def read_grid(self):
+        width = self.read('B')
+        cells = self.read_bytes()
+        return [cells[y:y + width] for y in range(0, len(cells), width)]
+
+    def write_random_state(self):
+        version, state, gauss_next = random.getstate()
+        self.write('BH', version, len(state))
+        self.write(f'{len(state)}I', *state)
+        self.write('?d', gauss_next is not None, gauss_next or 0.0)
+
+    def read_random_state(self):
+        version, length = self.read('BH')
+        state = self.read(f'{length}I')
+        has_gauss_next, gauss_next = self.read('?d')
+        random.setstate((version, state, gauss_next if has_gauss_next else None))
+
+
 def rotate_counterclockwise(shape):
     return [[shape[y][x] for y in range(len(shape))]
             for x in range(len(shape[0]) - 1, -1, -1)]
@@ -145,6 +276,11 @@ class TetrisView(arcade.View):
         super().__init__()
         self.background = arcade.load_texture(resource_path('bg.png'))
 
+    @property
+    def idle(self):
+        ''' Nothing is moving, so only redraw on input or at the idle rate '''
+        return False
+
     def on_draw(self):
         arcade.draw_lrwh_rectangle_textured(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, self.background)
 
@@ -153,9 +289,20 @@ class TetrisView(arcade.View):
         if hasattr(section, 'on_section_added'):
             section.on_section_added()
 
+    def quick_save(self, key, modifiers):
+        ''' Save to, or with shift held load from, the quick save slot for key '''
+        if key not in QUICKSAVE_KEYS:
+            return
+        if modifiers & arcade.key.MOD_SHIFT:
+            self.window.load_game(QUICKSAVE_KEYS[key])
+        else:
+            self.window.save_game(QUICKSAVE_KEYS[key])
+
     def on_key_press(self, key, modifiers):
         if key == arcade.key.ESCAPE:
             self.window.show_menu()
+        else:
+            self.quick_save(key, modifiers)
 
 
 class MenuItem(arcade.Section):
@@ -197,6 +344,10 @@ class MenuView(TetrisView):
 
         self.entries[0].selected = True
 
+    @property
+    def idle(self):
+        return True
+
     def on_draw(self):
         super().on_draw()
         self.__sprite_list.draw()
@@ -211,6 +362,8 @@ class MenuView(TetrisView):
             self.entries[idx + 1].selected = True
         elif key == arcade.key.ENTER:
             entry.handler()
+        else:
+            self.quick_save(key, modifiers)
         self.window.on_key_press(key, modifiers)
 
 
@@ -238,6 +391,12 @@ class Tetromino():
         if not self.board.check_collision(self.grid, new_x, self.y):
             self.x = new_x
 
+    def save(self, snapshot):
+        snapshot.write_grid(self.grid)
+
+    def load(self, snapshot):
+        self.grid = snapshot.read_grid()
+
     def rotate(self):
         new_grid = rotate_counterclockwise(self.grid)
         new_width = len(new_grid[0])
@@ -246,17 +405,20 @@ class Tetromino():
         if not self.board.check_collision(new_grid, self.x, self.y):
             self.grid = new_grid
 
-    def draw(self):
+    def draw(self, y=None, alpha=255):
+        if y is None:
+            y = self.y
         for row in range(len(self.grid)):
             for column in range(self.width):
                 if self.grid[row][column]:
                     x = (WIDTH * (column + self.x) + WIDTH // 2)
-                    y = (self.board.height - HEIGHT * (row + self.y) + HEIGHT // 2)
+                    y_pos = (self.board.height - HEIGHT * (row + y) + HEIGHT // 2)
                     texture = texture_list[self.grid[row][column]]
                     sprite = arcade.Sprite(texture=texture)
                     sprite.scale = float(WIDTH) / float(sprite.width)
+                    sprite.alpha = alpha
                     sprite.center_x = x + self.board.left
-                    sprite.center_y = y + self.board.bottom
+                    sprite.center_y = y_pos + self.board.bottom
                     if sprite.center_y < self.board.top:
                         sprite.draw()
 
@@ -266,6 +428,8 @@ class BoardSection(arcade.Section):
         super().__init__(left, bottom, width, height, prevent_dispatch={False}, prevent_dispatch_view={False}, **kwargs)
         self.rows_removed = 0
         self.__grid = [[0 for _x in range(COLUMN_COUNT)] for _y in range(ROW_COUNT + 1)]
+        # Row of the topmost occupied cell in each column, len(grid) when empty
+        self.__column_tops = [len(self.__grid) for _x in range(COLUMN_COUNT)]
         self.__sprite_list = setup_sprites(self.__grid, self.left, self.height, self.bottom)
         self.__rows_to_remove = []
         self.__garbage_to_add = 0
@@ -293,8 +457,46 @@ class BoardSection(arcade.Section):
                     return True
         return False
 
+    def save(self, snapshot):
+        snapshot.write_grid(self.__grid)
+        snapshot.write_bytes(self.__rows_to_remove)
+        snapshot.write('BBB', self.rows_removed, self.__garbage_to_add, self.__step)
+
+    def load(self, snapshot):
+        self.__grid = snapshot.read_grid()
+        self.__column_tops = [self.column_top(column) for column in range(COLUMN_COUNT)]
+        self.__rows_to_remove = snapshot.read_bytes()
+        self.rows_removed, self.__garbage_to_add, self.__step = snapshot.read('BBB')
+
+    def column_top(self, column, start=0):
+        ''' Find the first occupied row in column at or below start '''
+        for row in range(start, len(self.__grid)):
+            if self.__grid[row][column]:
+                return row
+        return len(self.__grid)
+
+    def landing_row(self, grid, x, y):
+        ''' Row a stone at x, y will come to rest at when dropped straight down '''
+        landing = len(self.__grid)
+        for cx in range(len(grid[0])):
+            cells = [cy for cy, row in enumerate(grid) if row[cx]]
+            bottom = cells[-1]
+            top = self.__column_tops[x + cx]
+            if top <= y + bottom:
+                # Stone is under an overhang or garbage has been pushed up into
+                # it, so only cells below its top cell can block it
+                top = self.column_top(x + cx, y + cells[0] + 1)
+            landing = min(landing, top - bottom - 1)
+        # A stone already blocked one row down locks where it is
+        return max(landing, y)
+
     def add_stone(self, stone):
         self.__grid = join_matrixes(self.__grid, stone.grid, (stone.x, stone.y))
+        for cy, row in enumerate(stone.grid):
+            for cx, cell in enumerate(row):
+                if cell:
+                    column = stone.x + cx
+                    self.__column_tops[column] = min(self.__column_tops[column], cy + stone.y - 1)
 
     def add_garbage(self, count):
         self.__garbage_to_add = count
@@ -320,10 +522,15 @@ class BoardSection(arcade.Section):
                 del self.__grid[row]
                 self.__grid.insert(0, [0 for _ in range(COLUMN_COUNT)])
                 del self.__rows_to_remove[i]
+                for column, top in enumerate(self.__column_tops):
+                    if top < row:
+                        self.__column_tops[column] = top + 1
                 return
             for column in range(len(self.__grid[row])):
                 if self.__grid[row][column] == 9:
                     self.__grid[row][column] = 0
+                    if self.__column_tops[column] == row:
+                        self.__column_tops[column] = self.column_top(column, row + 1)
                 elif self.__grid[row][column] != 0:
                     self.__explosion.play()
                     self.__grid[row][column] = 9
@@ -336,6 +543,15 @@ class BoardSection(arcade.Section):
             garbage_column = [8 for _x in range(COLUMN_COUNT)]
             garbage_column[random.randint(0, COLUMN_COUNT - 1)] = 0
             self.__grid.append(garbage_column)
+            for column, cell in enumerate(garbage_column):
+                top = self.__column_tops[column]
+                if top == 0:
+                    top = self.column_top(column)
+                elif top < len(self.__grid):
+                    top -= 1
+                if cell:
+                    top = min(top, len(self.__grid) - 1)
+                self.__column_tops[column] = top
             self.__garbage_to_add -= 1
             self.__hit.play()
 
@@ -385,6 +601,25 @@ class PlayerSection(arcade.Section):
             self.__incoming_garbage += count
         return self.__incoming_garbage
 
+    def save(self, snapshot):
+        snapshot.write('I?HhhH', self.frame_count, self.game_over, self.__level, self.__rows_remaining, self.speed, self.__incoming_garbage)
+        self.board_section.save(snapshot)
+        self.__next_stone.save(snapshot)
+        snapshot.write('?', self.stone is not None)
+        if self.stone:
+            self.stone.save(snapshot)
+            snapshot.write('bb', self.stone.x, self.stone.y)
+
+    def load(self, snapshot):
+        self.frame_count, self.game_over, self.__level, self.__rows_remaining, self.speed, self.__incoming_garbage = snapshot.read('I?HhhH')
+        self.board_section.load(snapshot)
+        self.__next_stone.load(snapshot)
+        if snapshot.read('?'):
+            self.stone.load(snapshot)
+            self.stone.x, self.stone.y = snapshot.read('bb')
+        else:
+            self.stone = None
+
     def new_stone(self):
         self.stone = self.__next_stone
         self.stone.y = 0
@@ -407,6 +642,12 @@ class PlayerSection(arcade.Section):
             self.stone = None
             self.board_section.remove_rows()
 
+    def hard_drop(self):
+        if not self.stone:
+            return
+        self.stone.y = self.board_section.landing_row(self.stone.grid, self.stone.x, self.stone.y)
+        self.drop()
+
     def rotate_stone(self):
         if not self.stone:
             return
@@ -441,6 +682,7 @@ class PlayerSection(arcade.Section):
                 self.__rows_remaining += 10
                 self.speed -= 1
             self.new_stone()
+            self.window.autosave()
 
     def move(self, delta_x):
         if not self.stone:
@@ -451,6 +693,9 @@ class PlayerSection(arcade.Section):
         if key == self.keymap['UP']:
             self.rotate_stone()
             return
+        elif key == self.keymap['HARD_DROP']:
+            self.hard_drop()
+            return
         elif key == self.keymap['LEFT']:
             self.move(-1)
         elif key == self.keymap['RIGHT']:
@@ -466,6 +711,8 @@ class PlayerSection(arcade.Section):
     def on_draw(self):
         arcade.draw_lrtb_rectangle_outline(self.left, self.right, self.top, self.bottom, (*arcade.color.ANTIQUE_FUCHSIA, 100), 5)
         if self.stone:
+            ghost_y = self.board_section.landing_row(self.stone.grid, self.stone.x, self.stone.y)
+            self.stone.draw(ghost_y, GHOST_ALPHA)
             self.stone.draw()
 
 
@@ -516,20 +763,22 @@ class GameOverSection(arcade.Section):
     def __init__(self):
         super().__init__(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, modal=True, enabled=False, prevent_dispatch_view={False})
         self.text = 'Game Over!'
+        self.__text = None
 
     def on_draw(self):
-        start_x = 0
-        start_y = SCREEN_HEIGHT / 2
-        text = arcade.Text(self.text,
-                           start_x,
-                           start_y,
-                           arcade.color.WHITE,
-                           80,
-                           width=SCREEN_WIDTH,
-                           align='center',
-                           bold=True)
+        if not self.__text or self.__text.text != self.text:
+            start_x = 0
+            start_y = SCREEN_HEIGHT / 2
+            self.__text = arcade.Text(self.text,
+                                      start_x,
+                                      start_y,
+                                      arcade.color.WHITE,
+                                      80,
+                                      width=SCREEN_WIDTH,
+                                      align='center',
+                                      bold=True)
         arcade.draw_lrtb_rectangle_filled(self.left, self.right, self.top, self.bottom, (128, 128, 128, 128))
-        text.draw()
+        self.__text.draw()
 
     def on_key_press(self, key, modifiers):
         if key == arcade.key.ESCAPE:
@@ -558,9 +807,21 @@ class SinglePlayerView(TetrisView):
     def game_over(self):
         return self.player_section.game_over
 
+    @property
+    def idle(self):
+        return self.game_over
+
     def score(self):
         return self.__score
 
+    def save(self, snapshot):
+        snapshot.write('I', self.__score)
+        self.player_section.save(snapshot)
+
+    def load(self, snapshot):
+        self.__score = snapshot.read('I')
+        self.player_section.load(snapshot)
+
     def on_rows_removed(self, rows_removed, player):
         if rows_removed == 1:
             self.__score += 100
@@ -604,6 +865,18 @@ class TwoPlayerView(TetrisView):
     def game_over(self):
         return self.player_one_section.game_over or self.player_two_section.game_over
 
+    @property
+    def idle(self):
+        return self.game_over
+
+    def save(self, snapshot):
+        self.player_one_section.save(snapshot)
+        self.player_two_section.save(snapshot)
+
+    def load(self, snapshot):
+        self.player_one_section.load(snapshot)
+        self.player_two_section.load(snapshot)
+
     def on_rows_removed(self, rows_removed, player):
         if rows_removed < 2:
             return
@@ -620,15 +893,91 @@ class TwoPlayerView(TetrisView):
             self.game_over_section.enabled = True
 
 
+game_modes = [SinglePlayerView, TwoPlayerView]
+
+
+def save_snapshot(view, path):
+    ''' Snapshot a game view and write it to path in the background '''
+    snapshot = Snapshot()
+    snapshot.write('B', game_modes.index(type(view)))
+    view.save(snapshot)
+    snapshot.write_random_state()
+    snapshot_writer.submit(write_file, path, snapshot.encode())
+
+
+def load_snapshot(path):
+    ''' Recreate a game view from a snapshot, None if there is no usable one '''
+    # Reading through the writer makes sure any pending save is finished first
+    data = snapshot_writer.submit(read_file, path).result()
+    if data is None:
+        return None
+    try:
+        snapshot = Snapshot.decode(data)
+        view = game_modes[snapshot.read('B')]()
+        view.load(snapshot)
+        snapshot.read_random_state()
+    except (ValueError, IndexError, TypeError, struct.error, zlib.error) as e:
+        print(f'Unable to load {path}: {e}')
+        return None
+    return view
+
+
 class MainWindow(arcade.Window):
     def __init__(self):
-        super().__init__(SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_TITLE, resizable=True)
+        self.idle = False
+        self.redraw = True
+        self.__skip_flip = False
+        super().__init__(SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_TITLE, resizable=True, update_rate=UPDATE_RATE)
         self.theme_music = arcade.Sound(resource_path('korobeiniki.wav'), streaming=True)
         self.music_player = self.theme_music.play(loop=True)
-        self.game_view = None
+        self.game_view = load_snapshot(SAVE_DIR / f'{AUTOSAVE_SLOT}.sav')
         self.show_menu()
 
+    def save_game(self, slot):
+        if self.game_view and not self.game_view.game_over:
+            save_snapshot(self.game_view, SAVE_DIR / f'{slot}.sav')
+
+    def load_game(self, slot):
+        game_view = load_snapshot(SAVE_DIR / f'{slot}.sav')
+        if game_view:
+            self.game_view = game_view
+            self.continue_game()
+
+    def autosave(self):
+        if self.game_view and self.game_view.game_over:
+            snapshot_writer.submit(remove_file, SAVE_DIR / f'{AUTOSAVE_SLOT}.sav')
+        else:
+            self.save_game(AUTOSAVE_SLOT)
+
+    def set_idle(self, idle):
+        ''' Slow down updates, and with them redraws, while nothing moves '''
+        if idle != self.idle:
+            self.idle = idle
+            self.set_update_rate(IDLE_UPDATE_RATE if idle else UPDATE_RATE)
+        self.redraw = True
+
+    def show_view(self, new_view):
+        super().show_view(new_view)
+        self.set_idle(new_view.idle)
+
+    def dispatch_event(self, event_type, *args):
+        if event_type == 'on_draw':
+            self.__skip_flip = self.idle and not self.redraw
+            if self.__skip_flip:
+                return None
+            self.redraw = False
+        return super().dispatch_event(event_type, *args)
+
+    def flip(self):
+        if not self.__skip_flip:
+            super().flip()
+
+    def on_update(self, dt):
+        # Also redraws idle screens at the idle update rate
+        self.set_idle(self.current_view.idle)
+
     def show_menu(self):
+        self.autosave()
         menu_entries = [] if not self.game_view or self.game_view.game_over else [
             ('Continue game', self.continue_game)
         ]
@@ -651,6 +1000,7 @@ class MainWindow(arcade.Window):
             self.music_player.play()
 
     def continue_game(self):
+        self.autosave()
         self.show_view(self.game_view)
 
     def new_single_player_game(self):
@@ -663,6 +1013,7 @@ class MainWindow(arcade.Window):
 
     def on_resize(self, width, height):
         super().on_resize(width, height)
+        self.redraw = True
         width_ratio = width / SCREEN_WIDTH
         height_ratio = height / SCREEN_HEIGHT
         if height_ratio < width_ratio:
@@ -672,7 +1023,11 @@ class MainWindow(arcade.Window):
         else:
             self.set_viewport(0, SCREEN_WIDTH, 0, height / width_ratio)
 
+    def on_expose(self):
+        self.redraw = True
+
     def on_key_press(self, key, modifiers):
+        self.redraw = True
         if key == arcade.key.F11:
             image = arcade.get_image()
             fname = f'screenshot-{datetime.now().replace(microsecond=0).isoformat()}'